@@ -9,12 +9,14 @@ import logging
 import os
 import re
 import sys
-import tempfile
-from typing import Tuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from typing import Optional, Tuple
 
 import requests
 from dotenv import load_dotenv
 from qcloud_cos import CosConfig, CosS3Client
+from qcloud_cos.cos_exception import CosServiceError
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 
@@ -24,6 +26,26 @@ COS_SECRET_ID = os.getenv("COS_SECRET_ID")
 COS_SECRET_KEY = os.getenv("COS_SECRET_KEY")
 COS_PATH_PREFIX = os.getenv("COS_PATH_PREFIX", "cc").lstrip("/").rstrip("/")
 
+# Number of platform binaries replicated concurrently
+MAX_WORKERS = 4
+
+# Size of each part in the multipart upload of platform binaries
+PART_SIZE = 32 * 1024 * 1024  # 32 MB
+
+# Number of parts of a single binary uploaded concurrently
+PART_WORKERS = 4
+
+# Object metadata recording the upstream ETag of a replicated file, the
+# src_base_url found in install.sh so that it survives an unchanged install.sh,
+# and the dst_base_url the install scripts were rewritten to
+SOURCE_ETAG_METADATA = "x-cos-meta-source-etag"
+SRC_BASE_URL_METADATA = "x-cos-meta-src-base-url"
+DST_BASE_URL_METADATA = "x-cos-meta-dst-base-url"
+
+# Pattern to match URLs like: GCS_BUCKET="https://storage.googleapis.com/..."
+# Match https:// followed by URL characters until whitespace, quote, or newline
+URL_PATTERN = re.compile(r'https://[^\s"\'\n\r]+')
+
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
 logger = logging.getLogger(__name__)
@@ -33,58 +55,185 @@ config = CosConfig(
     SecretId=COS_SECRET_ID,
     SecretKey=COS_SECRET_KEY,
     Scheme="https",
+    # Concurrent part uploads, plus one HEAD/PUT per platform binary
+    PoolConnections=10,
+    PoolMaxSize=MAX_WORKERS * PART_WORKERS + MAX_WORKERS,
 )
 client = CosS3Client(config)
 
+# Shared session so that requests to the same host reuse connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
+
 
-def simple_get(url: str) -> Tuple[str, bytes]:
-    res = requests.get(url)
+def simple_get(url: str) -> bytes:
+    """Download url, leaving decoding to the caller to skip charset detection."""
+    res = SESSION.get(url)
     res.raise_for_status()
-    return res.text, res.content
+    return res.content
 
 
-def simple_upload_content(content: str | bytes, key: str) -> None:
+def simple_upload_content(
+    content: str | bytes, key: str, metadata: Optional[dict] = None
+) -> None:
     if COS_PATH_PREFIX:
         key = COS_PATH_PREFIX + "/" + key
     if isinstance(content, str):
         content = content.encode("utf-8")
-    client.put_object(Bucket=COS_BUCKET, Body=content, Key=key)
+    client.put_object(Bucket=COS_BUCKET, Body=content, Key=key, Metadata=metadata or {})
+
+
+def simple_head_object(key: str) -> Optional[dict]:
+    """Return the headers of an uploaded object, or None if it does not exist."""
+    if COS_PATH_PREFIX:
+        key = COS_PATH_PREFIX + "/" + key
+    try:
+        return client.head_object(Bucket=COS_BUCKET, Key=key)
+    except CosServiceError as e:
+        if e.get_status_code() == 404:
+            return None
+        raise
+
+
+def simple_get_object(key: str) -> Optional[bytes]:
+    """Return the content of an uploaded object, or None if it does not exist."""
+    if COS_PATH_PREFIX:
+        key = COS_PATH_PREFIX + "/" + key
+    try:
+        res = client.get_object(Bucket=COS_BUCKET, Key=key)
+    except CosServiceError as e:
+        if e.get_status_code() == 404:
+            return None
+        raise
+    return res["Body"].get_raw_stream().read()
+
+
+def simple_get_if_changed(
+    url: str, key: str, expected_metadata: Optional[dict] = None
+) -> Tuple[Optional[bytes], dict]:
+    """
+    Download url unless it is unchanged since it was last uploaded to key.
+
+    Sends the upstream ETag recorded on the uploaded object as If-None-Match,
+    but only if the object also carries every item of expected_metadata (a None
+    value only requires the key to be present), as the upload depends on them.
+    Returns (None, metadata of the uploaded object) when upstream answers 304,
+    otherwise (content, metadata to store with the new upload).
+    """
+    existing = simple_head_object(key) or {}
+    metadata = {
+        k.lower(): v for k, v in existing.items() if k.lower().startswith("x-cos-meta-")
+    }
+    etag = metadata.get(SOURCE_ETAG_METADATA)
+    for k, v in (expected_metadata or {}).items():
+        if k not in metadata or (v is not None and metadata[k] != v):
+            etag = None
+
+    res = SESSION.get(url, headers={"If-None-Match": etag} if etag else {})
+    if res.status_code == 304:
+        return None, metadata
+    res.raise_for_status()
+
+    metadata = {}
+    if res.headers.get("ETag"):
+        metadata[SOURCE_ETAG_METADATA] = res.headers["ETag"]
+    return res.content, metadata
 
 
 def extract_src_base_url(install_sh_content: str) -> str:
     """Extract the first complete HTTPS URL from install.sh content."""
-    # Pattern to match URLs like: GCS_BUCKET="https://storage.googleapis.com/..."
-    # Match https:// followed by URL characters until whitespace, quote, or newline
-    pattern = r'https://[^\s"\'\n\r]+'
-    matches = re.findall(pattern, install_sh_content)
-    if not matches:
+    match = URL_PATTERN.search(install_sh_content)
+    if not match:
         raise ValueError("No HTTPS URL found in install.sh")
     # Return the first complete URL, strip trailing quotes if any
-    url = matches[0].rstrip('"').rstrip("'")
+    url = match.group(0).rstrip('"').rstrip("'")
     return url
 
 
-def simple_download_and_upload(url: str, key: str) -> None:
+def simple_upload_part(key: str, upload_id: str, part_number: int, body: bytes) -> dict:
+    res = client.upload_part(
+        Bucket=COS_BUCKET,
+        Key=key,
+        Body=body,
+        PartNumber=part_number,
+        UploadId=upload_id,
+    )
+    return {"PartNumber": part_number, "ETag": res["ETag"]}
+
+
+def simple_download_and_upload(url: str, key: str) -> bool:
+    """
+    Stream url into COS without touching local disk.
+
+    Binaries that fit in a single part are uploaded with one put_object, larger
+    ones are streamed part by part into a multipart upload.
+
+    Returns False if the object already exists with the same size as the source
+    and the transfer was skipped, True otherwise.
+    """
+    existing = simple_head_object(key)
+    if existing is not None:
+        head = SESSION.head(url, allow_redirects=True)
+        head.raise_for_status()
+        if existing.get("Content-Length") == head.headers.get("Content-Length"):
+            return False
+
     if COS_PATH_PREFIX:
         key = COS_PATH_PREFIX + "/" + key
 
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        local_path = tmp_file.name
-        try:
-            res = requests.get(url, stream=True)
-            res.raise_for_status()
-            for chunk in res.iter_content(chunk_size=8192):
-                tmp_file.write(chunk)
-            tmp_file.flush()
-
-            client.upload_file(
-                COS_BUCKET,
-                key,
-                local_path,
-                PartSize=128 * 1024 * 1024,  # 128 MB
-            )
-        finally:
-            os.unlink(local_path)
+    res = SESSION.get(url, stream=True)
+    res.raise_for_status()
+
+    size = res.headers.get("Content-Length")
+    if size is not None and int(size) <= PART_SIZE:
+        client.put_object(Bucket=COS_BUCKET, Body=res.content, Key=key)
+        return True
+
+    upload_id = client.create_multipart_upload(Bucket=COS_BUCKET, Key=key)["UploadId"]
+    try:
+        futures = []
+        buffer = bytearray()
+        with ThreadPoolExecutor(max_workers=PART_WORKERS) as executor:
+            for chunk in res.iter_content(chunk_size=1024 * 1024):
+                buffer.extend(chunk)
+                # Upload full parts as soon as they fill up; only the last may be smaller
+                while len(buffer) >= PART_SIZE:
+                    # Bound memory usage by waiting for a free upload slot
+                    pending = [f for f in futures if not f.done()]
+                    if len(pending) >= PART_WORKERS:
+                        wait(pending, return_when=FIRST_COMPLETED)
+                    # Stop downloading as soon as any part has failed to upload
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+                    # Copy the part out of the buffer once, without an extra slice
+                    with memoryview(buffer) as view:
+                        body = bytes(view[:PART_SIZE])
+                    del buffer[:PART_SIZE]
+                    futures.append(
+                        executor.submit(
+                            simple_upload_part, key, upload_id, len(futures) + 1, body
+                        )
+                    )
+            if buffer or not futures:
+                futures.append(
+                    executor.submit(
+                        simple_upload_part, key, upload_id, len(futures) + 1, bytes(buffer)
+                    )
+                )
+        parts = [future.result() for future in futures]
+
+        client.complete_multipart_upload(
+            Bucket=COS_BUCKET,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Part": parts},
+        )
+    except Exception:
+        client.abort_multipart_upload(Bucket=COS_BUCKET, Key=key, UploadId=upload_id)
+        raise
+
+    return True
 
 
 def main():
@@ -99,47 +248,110 @@ def main():
     if COS_PATH_PREFIX:
         dst_base_url = f"{dst_base_url}/{COS_PATH_PREFIX}"
 
-    # Download and process install.sh
-    install_sh, raw_install_sh = simple_get("https://claude.ai/install.sh")
-    src_base_url = extract_src_base_url(install_sh)
-    logger.info(f"extracted src_base_url: {src_base_url}")
-
-    # Replace URL in install.sh and upload (replace in text first, then encode)
-    modified_install_sh_text = install_sh.replace(src_base_url, dst_base_url)
-    simple_upload_content(modified_install_sh_text, "install.sh")
-    logger.info("uploaded install.sh")
-
-    # Download and process install.ps1
-    install_ps1, raw_install_ps1 = simple_get("https://claude.ai/install.ps1")
-    if src_base_url not in install_ps1:
-        raise ValueError("src_base_url not found in install.ps1")
-
-    # Replace URL in install.ps1 and upload (replace in text first, then encode)
-    modified_install_ps1_text = install_ps1.replace(src_base_url, dst_base_url)
-    simple_upload_content(modified_install_ps1_text, "install.ps1")
-    logger.info("uploaded install.ps1")
-
-    # Download latest version file
-    version_text, raw_version = simple_get(f"{src_base_url}/latest")
-    version = version_text.strip()  # Remove any newlines/whitespace
-    simple_upload_content(raw_version, "latest")
+    # Independent downloads run concurrently, each is waited for when needed.
+    # Files unchanged upstream since their last upload are skipped entirely.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        install_sh_future = executor.submit(
+            simple_get_if_changed,
+            "https://claude.ai/install.sh",
+            "install.sh",
+            {DST_BASE_URL_METADATA: dst_base_url, SRC_BASE_URL_METADATA: None},
+        )
+        install_ps1_future = executor.submit(
+            simple_get_if_changed,
+            "https://claude.ai/install.ps1",
+            "install.ps1",
+            {DST_BASE_URL_METADATA: dst_base_url},
+        )
+        uploaded_version_future = executor.submit(simple_get_object, "latest")
+
+        # Download and process install.sh
+        raw_install_sh, install_sh_metadata = install_sh_future.result()
+        if raw_install_sh is None:
+            src_base_url = install_sh_metadata[SRC_BASE_URL_METADATA]
+            logger.info(f"install.sh unchanged, src_base_url: {src_base_url}")
+        else:
+            install_sh = raw_install_sh.decode("utf-8")
+            src_base_url = extract_src_base_url(install_sh)
+            logger.info(f"extracted src_base_url: {src_base_url}")
+
+        # Download latest version file, it is uploaded last so that an interrupted
+        # run never publishes a version whose files are incomplete
+        version_future = executor.submit(
+            simple_get_if_changed, f"{src_base_url}/latest", "latest"
+        )
+
+        if raw_install_sh is not None:
+            # Replace URL in install.sh and upload (replace in text first, then encode)
+            modified_install_sh_text = install_sh.replace(src_base_url, dst_base_url)
+            install_sh_metadata[SRC_BASE_URL_METADATA] = src_base_url
+            install_sh_metadata[DST_BASE_URL_METADATA] = dst_base_url
+            simple_upload_content(
+                modified_install_sh_text, "install.sh", install_sh_metadata
+            )
+            logger.info("uploaded install.sh")
+
+        # Download and process install.ps1
+        raw_install_ps1, install_ps1_metadata = install_ps1_future.result()
+        if raw_install_ps1 is None:
+            logger.info("install.ps1 unchanged")
+        else:
+            install_ps1 = raw_install_ps1.decode("utf-8")
+            if src_base_url not in install_ps1:
+                raise ValueError("src_base_url not found in install.ps1")
+
+            # Replace URL in install.ps1 and upload (replace in text first, then encode)
+            modified_install_ps1_text = install_ps1.replace(src_base_url, dst_base_url)
+            install_ps1_metadata[DST_BASE_URL_METADATA] = dst_base_url
+            simple_upload_content(
+                modified_install_ps1_text, "install.ps1", install_ps1_metadata
+            )
+            logger.info("uploaded install.ps1")
+
+        raw_version, version_metadata = version_future.result()
+        uploaded_version = uploaded_version_future.result()
+
+    # latest is uploaded after everything else, so an unchanged latest means the
+    # previous run already replicated the whole version
+    if raw_version is None:
+        version = uploaded_version.decode("utf-8").strip()
+        logger.info(f"latest unchanged, version {version} is already replicated")
+        return
+
+    version = raw_version.decode("utf-8").strip()  # Remove any newlines/whitespace
     logger.info(f"version: {version}")
 
     # Download manifest.json
-    manifest_text, raw_manifest = simple_get(f"{src_base_url}/{version}/manifest.json")
-    manifest_json = json.loads(manifest_text)
+    raw_manifest = simple_get(f"{src_base_url}/{version}/manifest.json")
+    manifest_json = json.loads(raw_manifest)
     platforms = list(manifest_json["platforms"].keys())
-    simple_upload_content(raw_manifest, f"{version}/manifest.json")
+    # Everything under {version}/ is immutable, so like the binaries, an existing
+    # manifest.json of the same size is already replicated
+    manifest_key = f"{version}/manifest.json"
+    existing = simple_head_object(manifest_key)
+    if existing is None or existing.get("Content-Length") != str(len(raw_manifest)):
+        simple_upload_content(raw_manifest, manifest_key)
+        logger.info(f"uploaded {manifest_key}")
     logger.info(f"platforms: {platforms}")
 
-    # Download and upload binaries for each platform
-    for platform in platforms:
-        binary_name = "claude.exe" if platform.startswith("win") else "claude"
-        src_url = f"{src_base_url}/{version}/{platform}/{binary_name}"
-        dst_key = f"{version}/{platform}/{binary_name}"
-        logger.info(f"downloading {src_url}...")
-        simple_download_and_upload(src_url, dst_key)
-        logger.info(f"uploaded {dst_key}")
+    # Download and upload binaries for each platform concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for platform in platforms:
+            binary_name = "claude.exe" if platform.startswith("win") else "claude"
+            src_url = f"{src_base_url}/{version}/{platform}/{binary_name}"
+            dst_key = f"{version}/{platform}/{binary_name}"
+            logger.info(f"replicating {src_url}...")
+            future = executor.submit(simple_download_and_upload, src_url, dst_key)
+            futures[future] = dst_key
+        for future in as_completed(futures):
+            if future.result():
+                logger.info(f"uploaded {futures[future]}")
+            else:
+                logger.info(f"skipped {futures[future]}, already up to date")
+
+    simple_upload_content(raw_version, "latest", version_metadata)
+    logger.info("uploaded latest")
 
     logger.info("All files replicated successfully!")
 
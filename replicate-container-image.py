@@ -4,14 +4,24 @@
 # dependencies = ["requests", "python-dotenv"]
 # ///
 
+import base64
+import codecs
+import hashlib
+import json
 import logging
 import os
-import subprocess
+import re
 import sys
-from urllib.parse import urlparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, Optional
+from urllib.parse import urljoin, urlparse
 
 import requests
+import urllib3
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 load_dotenv()
 
@@ -19,9 +29,70 @@ REGISTRY_USERNAME = os.getenv("REGISTRY_USERNAME")
 REGISTRY_PASSWORD = os.getenv("REGISTRY_PASSWORD")
 REGISTRY_BASE_URL = os.getenv("REGISTRY_BASE_URL", "").rstrip("/")
 
+# Number of images replicated concurrently
+MAX_WORKERS = 4
+
+# Number of blobs (config and layers) of a single image copied concurrently
+BLOB_WORKERS = 4
+
+# Retries of failed registry requests, with exponential backoff in seconds
+RETRIES = 5
+RETRY_BACKOFF = 1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Image reference: [REGISTRY/]PATH[:TAG], where REGISTRY is the first component
+# if it contains a dot or a port, or is localhost
+IMAGE_PATTERN = re.compile(
+    r"^(?:(?P<registry>[^/]*[.:][^/]*|localhost)/)?"
+    r"(?P<path>[^:@]+?)"
+    r"(?::(?P<tag>[^:/@]+))?$"
+)
+
+# Manifest media types accepted from source registries
+INDEX_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+# Registry credentials by host, other registries are accessed anonymously
+CREDENTIALS: dict[str, tuple[str, str]] = {}
+
+# Auth challenges by registry ((scheme, params), or None for anonymous access),
+# and authorization headers with their expiry by (registry, scope)
+CHALLENGES: dict[str, Optional[tuple[str, dict[str, str]]]] = {}
+TOKENS: dict[tuple[str, Optional[str]], tuple[dict[str, str], float]] = {}
+
+# AUTH_LOCK only guards the dicts above and is never held during network I/O,
+# fetches are serialized per registry (challenges) or per scope (tokens)
+AUTH_LOCK = threading.Lock()
+FETCH_LOCKS: dict[tuple, threading.Lock] = {}
+
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
+# Shared session so that requests to the same host reuse connections
+SESSION = requests.Session()
+# GET and HEAD requests are retried by the adapter, blob uploads stream their
+# body and are retried as a whole in copy_blob instead
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=MAX_WORKERS * BLOB_WORKERS,
+        max_retries=urllib3.util.Retry(
+            total=RETRIES,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods={"GET", "HEAD"},
+            raise_on_status=False,
+        ),
+    ),
+)
+
 
 def parse_image(image: str) -> tuple[str, str, str]:
     """
@@ -33,24 +104,13 @@ def parse_image(image: str) -> tuple[str, str, str]:
     - nginx:latest -> ("docker.io", "library/nginx", "latest")
     - org/name -> ("docker.io", "org/name", "latest")
     """
-    # Split tag first
-    if ":" in image:
-        image_part, tag = image.rsplit(":", 1)
-    else:
-        image_part = image
-        tag = "latest"
-
-    # Split into parts
-    parts = image_part.split("/")
-
-    # Detect registry (contains a dot or is localhost)
-    if len(parts) >= 2 and ("." in parts[0] or parts[0] == "localhost"):
-        registry = parts[0]
-        path = "/".join(parts[1:])
-    else:
-        # No explicit registry, default to docker.io
-        registry = "docker.io"
-        path = image_part
+    match = IMAGE_PATTERN.match(image)
+    if not match:
+        raise ValueError(f"Invalid image reference: {image}")
+    # No explicit registry, default to docker.io
+    registry = match.group("registry") or "docker.io"
+    path = match.group("path")
+    tag = match.group("tag") or "latest"
 
     # For docker.io, auto-add "library/" for single-name images
     if registry == "docker.io" and "/" not in path:
@@ -76,75 +136,301 @@ def build_target_image(registry: str, path: str, tag: str) -> str:
     return f"{REGISTRY_BASE_URL}/{final_name}:{tag}"
 
 
-def docker_login(username: str, password: str, registry: str) -> None:
-    """Login to Docker registry."""
+class BlobReader:
+    """File-like wrapper that lets requests stream a blob with a Content-Length."""
+
+    def __init__(self, raw, size: int):
+        self.raw = raw
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def read(self, amt: int = -1) -> bytes:
+        return self.raw.read(None if amt < 0 else amt)
+
+
+def registry_endpoint(registry: str) -> str:
+    """Return the base URL of the registry HTTP API."""
+    if registry == "docker.io":
+        return "https://registry-1.docker.io"
+    return f"https://{registry}"
+
+
+def fetch_lock(key: tuple) -> threading.Lock:
+    """Return the lock serializing fetches of one cached auth entry."""
+    with AUTH_LOCK:
+        return FETCH_LOCKS.setdefault(key, threading.Lock())
+
+
+def registry_challenge(registry: str) -> Optional[tuple[str, dict[str, str]]]:
+    """Return the (scheme, params) auth challenge of registry, cached per registry."""
+    with AUTH_LOCK:
+        if registry in CHALLENGES:
+            return CHALLENGES[registry]
+
+    with fetch_lock(("challenge", registry)):
+        # Another thread may have fetched it while this one was waiting
+        with AUTH_LOCK:
+            if registry in CHALLENGES:
+                return CHALLENGES[registry]
+
+        res = SESSION.get(f"{registry_endpoint(registry)}/v2/")
+        if res.status_code == 401:
+            challenge = res.headers.get("WWW-Authenticate", "")
+            scheme, _, params = challenge.partition(" ")
+            params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+            result = (scheme.lower(), params)
+        else:
+            res.raise_for_status()
+            result = None
+
+        with AUTH_LOCK:
+            CHALLENGES[registry] = result
+        return result
+
+
+def registry_auth(registry: str, scope: Optional[str] = None) -> dict[str, str]:
+    """
+    Authenticate against registry, returning the headers for subsequent requests.
+
+    Follows the WWW-Authenticate challenge of the /v2/ endpoint, fetching a
+    bearer token for scope (e.g. "repository:library/nginx:pull") when required.
+    Tokens are cached per scope and refreshed shortly before they expire.
+    """
+    challenge = registry_challenge(registry)
+    if challenge is None:
+        return {}
+
+    scheme, params = challenge
+    credentials = CREDENTIALS.get(registry)
+
+    if scheme == "basic":
+        if not credentials:
+            raise RuntimeError(f"Registry {registry} requires credentials")
+        token = base64.b64encode(":".join(credentials).encode("utf-8")).decode("ascii")
+        return {"Authorization": f"Basic {token}"}
+
+    if scheme != "bearer":
+        raise RuntimeError(f"Unsupported auth scheme for {registry}: {scheme}")
+
+    key = (registry, scope)
+    with AUTH_LOCK:
+        cached = TOKENS.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    with fetch_lock(("token", *key)):
+        # Another thread may have refreshed it while this one was waiting
+        with AUTH_LOCK:
+            cached = TOKENS.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+
+        query = {}
+        if "service" in params:
+            query["service"] = params["service"]
+        if scope:
+            query["scope"] = scope
+        res = SESSION.get(params["realm"], params=query, auth=credentials)
+        res.raise_for_status()
+        body = res.json()
+        token = body.get("token") or body["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        # Tokens are valid for 60 seconds unless stated otherwise, refresh early
+        expires_at = time.monotonic() + body.get("expires_in", 60) - 10
+        with AUTH_LOCK:
+            TOKENS[key] = (headers, expires_at)
+        return headers
+
+
+def registry_login(username: str, password: str, registry: str) -> None:
+    """Login to registry, verifying the credentials against its API."""
     logger.info(f"Logging in to {registry}...")
-    cmd = [
-        "docker",
-        "login",
-        "-u",
-        username,
-        "--password-stdin",
-        registry,
-    ]
-    result = subprocess.run(cmd, input=password, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"docker login failed: {result.stderr}")
+    CREDENTIALS[registry] = (username, password)
+    headers = registry_auth(registry)
+    res = SESSION.get(f"{registry_endpoint(registry)}/v2/", headers=headers)
+    if res.status_code != 200:
+        raise RuntimeError(f"registry login failed: {res.status_code} {res.text}")
     logger.info("Login successful")
 
 
-def docker_pull(image: str) -> None:
-    """Pull Docker image with platform linux/amd64."""
-    logger.info(f"Pulling {image}...")
-    cmd = [
-        "docker",
-        "pull",
-        "--platform",
-        "linux/amd64",
-        image,
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"docker pull failed: {result.stderr}")
-    logger.info(f"Pulled {image} successfully")
-
-
-def docker_tag(source: str, target: str) -> None:
-    """Tag Docker image."""
-    logger.info(f"Tagging {source} as {target}...")
-    cmd = ["docker", "tag", source, target]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"docker tag failed: {result.stderr}")
-    logger.info(f"Tagged {source} as {target}")
-
-
-def docker_push(image: str) -> None:
-    """Push Docker image."""
-    logger.info(f"Pushing {image}...")
-    cmd = ["docker", "push", "--platform", "linux/amd64", image]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"docker push failed: {result.stderr}")
-    logger.info(f"Pushed {image} successfully")
-
-
-def fetch_images_from_url(url: str) -> list[str]:
-    """Fetch URL and parse each line as an image."""
+def get_manifest(
+    registry: str, path: str, reference: str, scope: str
+) -> tuple[bytes, str]:
+    """Fetch a manifest (or index), returning (raw manifest, media type)."""
+    res = SESSION.get(
+        f"{registry_endpoint(registry)}/v2/{path}/manifests/{reference}",
+        headers={
+            **registry_auth(registry, scope),
+            "Accept": ", ".join(INDEX_MEDIA_TYPES + MANIFEST_MEDIA_TYPES),
+        },
+    )
+    res.raise_for_status()
+    media_type = res.headers.get("Content-Type", "").split(";")[0].strip()
+    if not media_type:
+        media_type = json.loads(res.content).get("mediaType", "")
+    return res.content, media_type
+
+
+def get_manifest_digest(
+    registry: str, path: str, reference: str, scope: str
+) -> Optional[str]:
+    """Return the digest of a manifest, or None if it does not exist."""
+    res = SESSION.head(
+        f"{registry_endpoint(registry)}/v2/{path}/manifests/{reference}",
+        headers={
+            **registry_auth(registry, scope),
+            "Accept": ", ".join(INDEX_MEDIA_TYPES + MANIFEST_MEDIA_TYPES),
+        },
+    )
+    if res.status_code == 404:
+        return None
+    res.raise_for_status()
+    return res.headers.get("Docker-Content-Digest")
+
+
+def get_blob(registry: str, path: str, digest: str, scope: str) -> bytes:
+    """Fetch a small blob, such as an image config, into memory."""
+    res = SESSION.get(
+        f"{registry_endpoint(registry)}/v2/{path}/blobs/{digest}",
+        headers=registry_auth(registry, scope),
+    )
+    res.raise_for_status()
+    return res.content
+
+
+def get_platform_manifest(
+    registry: str, path: str, tag: str, scope: str
+) -> tuple[bytes, str]:
+    """
+    Fetch the linux/amd64 manifest of an image.
+
+    Multi-platform indexes are narrowed down to the linux/amd64 entry by digest,
+    single-platform manifests are checked against the platform in their config.
+    """
+    manifest, media_type = get_manifest(registry, path, tag, scope)
+    if media_type in INDEX_MEDIA_TYPES:
+        for entry in json.loads(manifest)["manifests"]:
+            platform = entry.get("platform", {})
+            if (platform.get("os"), platform.get("architecture")) == ("linux", "amd64"):
+                manifest, media_type = get_manifest(
+                    registry, path, entry["digest"], scope
+                )
+                break
+        else:
+            raise RuntimeError(f"No linux/amd64 manifest found for {registry}/{path}")
+    elif media_type in MANIFEST_MEDIA_TYPES:
+        config_digest = json.loads(manifest)["config"]["digest"]
+        config = json.loads(get_blob(registry, path, config_digest, scope))
+        platform = f"{config.get('os')}/{config.get('architecture')}"
+        if platform != "linux/amd64":
+            raise RuntimeError(
+                f"{registry}/{path}:{tag} is {platform}, not linux/amd64"
+            )
+    if media_type not in MANIFEST_MEDIA_TYPES:
+        raise RuntimeError(f"Unsupported manifest media type: {media_type}")
+    return manifest, media_type
+
+
+def copy_blob(
+    src_registry: str,
+    src_path: str,
+    src_scope: str,
+    dst_registry: str,
+    dst_path: str,
+    dst_scope: str,
+    descriptor: dict,
+) -> None:
+    """Stream a blob from the source repository into the target repository."""
+    digest = descriptor["digest"]
+    dst_endpoint = registry_endpoint(dst_registry)
+
+    # Skip blobs the target repository already has
+    blob_url = f"{dst_endpoint}/v2/{dst_path}/blobs/{digest}"
+    res = SESSION.head(blob_url, headers=registry_auth(dst_registry, dst_scope))
+    if res.status_code == 200:
+        logger.info(f"Blob {digest} already exists")
+        return
+
+    # A streamed upload cannot be replayed, so a failed attempt starts over
+    # from the source GET with a new upload session
+    for attempt in range(RETRIES + 1):
+        try:
+            logger.info(f"Copying blob {digest} ({descriptor['size']} bytes)...")
+            src = SESSION.get(
+                f"{registry_endpoint(src_registry)}/v2/{src_path}/blobs/{digest}",
+                headers=registry_auth(src_registry, src_scope),
+                stream=True,
+            )
+            src.raise_for_status()
+
+            with src:
+                upload_url = f"{dst_endpoint}/v2/{dst_path}/blobs/uploads/"
+                res = SESSION.post(
+                    upload_url, headers=registry_auth(dst_registry, dst_scope)
+                )
+                res.raise_for_status()
+                location = urljoin(res.url, res.headers["Location"])
+
+                res = SESSION.put(
+                    location,
+                    params={"digest": digest},
+                    data=BlobReader(src.raw, descriptor["size"]),
+                    headers={
+                        **registry_auth(dst_registry, dst_scope),
+                        "Content-Type": "application/octet-stream",
+                    },
+                )
+                res.raise_for_status()
+            return
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            response = getattr(e, "response", None)
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                raise
+            if attempt == RETRIES:
+                raise
+            delay = RETRY_BACKOFF * 2**attempt
+            logger.warning(f"Copying blob {digest} failed: {e}, retrying in {delay}s")
+            time.sleep(delay)
+
+
+def put_manifest(
+    registry: str,
+    path: str,
+    tag: str,
+    scope: str,
+    manifest: bytes,
+    media_type: str,
+) -> None:
+    """Upload a manifest to the target repository."""
+    res = SESSION.put(
+        f"{registry_endpoint(registry)}/v2/{path}/manifests/{tag}",
+        data=manifest,
+        headers={**registry_auth(registry, scope), "Content-Type": media_type},
+    )
+    res.raise_for_status()
+
+
+def fetch_images_from_url(url: str) -> Iterator[str]:
+    """Fetch URL and yield each line as an image, streaming the response."""
     logger.info(f"Fetching images from {url}...")
-    response = requests.get(url)
-    response.raise_for_status()
-    images = []
-    for line in response.text.strip().split("\n"):
-        line = line.strip()
-        if line and not line.startswith("#"):
-            images.append(line)
-    logger.info(f"Found {len(images)} images from URL")
-    return images
+    count = 0
+    with SESSION.get(url, stream=True) as response:
+        response.raise_for_status()
+        # Filter raw lines and only decode the image references. A stray BOM or
+        # non-ASCII character must only fail that one image, not the whole list.
+        for line in response.iter_lines(chunk_size=65536):
+            line = line.removeprefix(codecs.BOM_UTF8).strip()
+            if line and not line.startswith(b"#"):
+                count += 1
+                yield line.decode("utf-8", "replace")
+    logger.info(f"Found {count} images from URL")
 
 
 def replicate_image(source_image: str) -> None:
-    """Replicate a single image: pull, tag, and push."""
+    """Replicate a single image: copy its linux/amd64 manifest to the target."""
     logger.info(f"Processing image: {source_image}")
 
     # Parse source image
@@ -154,14 +440,38 @@ def replicate_image(source_image: str) -> None:
     logger.info(f"Source: {source_image}")
     logger.info(f"Target: {target_image}")
 
-    # Pull source image
-    docker_pull(source_image)
-
-    # Tag image
-    docker_tag(source_image, target_image)
-
-    # Push target image
-    docker_push(target_image)
+    # Token scopes for both sides of the copy
+    target_registry, target_path, _ = parse_image(target_image)
+    src_scope = f"repository:{path}:pull"
+    dst_scope = f"repository:{target_path}:pull,push"
+
+    # Copy the linux/amd64 image registry to registry, blobs before the manifest
+    manifest, media_type = get_platform_manifest(registry, path, tag, src_scope)
+
+    # Skip images whose target tag already points at the same manifest
+    digest = "sha256:" + hashlib.sha256(manifest).hexdigest()
+    if get_manifest_digest(target_registry, target_path, tag, dst_scope) == digest:
+        logger.info(f"{target_image} is already up to date")
+        return
+
+    manifest_json = json.loads(manifest)
+    with ThreadPoolExecutor(max_workers=BLOB_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                copy_blob,
+                registry,
+                path,
+                src_scope,
+                target_registry,
+                target_path,
+                dst_scope,
+                descriptor,
+            )
+            for descriptor in [manifest_json["config"], *manifest_json["layers"]]
+        ]
+        for future in as_completed(futures):
+            future.result()
+    put_manifest(target_registry, target_path, tag, dst_scope, manifest, media_type)
 
     logger.info(f"Successfully replicated {source_image} -> {target_image}")
 
@@ -178,7 +488,7 @@ def main():
     registry_host = parsed.netloc or parsed.path.split("/")[0]
 
     # Login to registry
-    docker_login(REGISTRY_USERNAME, REGISTRY_PASSWORD, registry_host)
+    registry_login(REGISTRY_USERNAME, REGISTRY_PASSWORD, registry_host)
 
     # Parse arguments
     images = []
@@ -190,18 +500,37 @@ def main():
             # Treat as direct image reference
             images.append(arg)
 
+    # Drop duplicates while preserving order, including different spellings of
+    # the same image (nginx, nginx:latest, docker.io/library/nginx), keeping
+    # the first one. Invalid references are kept to fail in replicate_image.
+    unique_images: dict[object, str] = {}
+    for image in images:
+        try:
+            key: object = parse_image(image)
+        except ValueError:
+            key = image
+        unique_images.setdefault(key, image)
+    images = list(unique_images.values())
+
     if not images:
         raise ValueError(
             "No images provided. Provide image names or URLs as arguments."
         )
 
-    # Replicate each image
-    for image in images:
-        try:
-            replicate_image(image)
-        except Exception as e:
-            logger.error(f"Failed to replicate {image}: {e}")
-            raise
+    # Replicate images concurrently, reporting failures once all have finished
+    failed = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(replicate_image, image): image for image in images}
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to replicate {image}: {e}")
+                failed.append(image)
+
+    if failed:
+        raise RuntimeError(f"Failed to replicate {len(failed)} images: {failed}")
 
     logger.info("All images replicated successfully!")
 